@@ -0,0 +1,274 @@
+# Pre-aggregated audit analytics for CYBAK admin dashboard
+
+import datetime
+import json
+import math
+import threading
+import time
+
+import numpy as np
+
+SCORE_BUCKETS = 10  # 0-9, 10-19, ..., 90-100
+SEVERITIES = ('critical', 'major', 'minor')
+
+# How long a worker trusts its in-memory columns before reloading them. The
+# summary tables are small, so they load from the primary rather than the admin
+# snapshot: completions from other workers show up within this TTL, and the
+# worker that committed a completion sees it on its next query.
+COLUMN_CACHE_TTL_SECONDS = 30
+
+def init_analytics_tables(conn):
+    """Create the daily summary tables (one row per day and plan)"""
+    bucket_columns = ',\n'.join(f'            score_bucket_{i} INTEGER NOT NULL DEFAULT 0' for i in range(SCORE_BUCKETS))
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS audit_daily_summary (
+            day TEXT NOT NULL,
+            plan_type TEXT NOT NULL,
+            audits INTEGER NOT NULL DEFAULT 0,
+            scored_audits INTEGER NOT NULL DEFAULT 0,
+            score_sum REAL NOT NULL DEFAULT 0,
+            critical_issues INTEGER NOT NULL DEFAULT 0,
+            major_issues INTEGER NOT NULL DEFAULT 0,
+            minor_issues INTEGER NOT NULL DEFAULT 0,
+{bucket_columns},
+            PRIMARY KEY (day, plan_type)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS audit_issue_daily (
+            day TEXT NOT NULL,
+            plan_type TEXT NOT NULL,
+            issue_type TEXT NOT NULL,
+            occurrences INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, plan_type, issue_type)
+        )
+    ''')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(audit_daily_summary)')]
+    if 'scored_audits' not in columns:
+        # Older summaries counted unscored audits as 0; recompute them with the new column
+        conn.execute('ALTER TABLE audit_daily_summary ADD COLUMN scored_audits INTEGER NOT NULL DEFAULT 0')
+        rebuild_summaries(conn)
+
+def summarize_results(results):
+    """Extract score, severity counts and issue types from an audit result payload"""
+    if isinstance(results, str):
+        try:
+            results = json.loads(results)
+        except ValueError:
+            results = {}
+    if not isinstance(results, dict):
+        results = {}
+
+    # None when the scan reported no score; such audits stay out of score statistics
+    try:
+        score = float(results['security_score'])
+    except (KeyError, TypeError, ValueError):
+        score = None
+    if score is not None:
+        score = min(max(score, 0.0), 100.0) if math.isfinite(score) else None
+
+    scan_details = results.get('scan_details')
+    vulnerabilities = scan_details.get('vulnerabilities') if isinstance(scan_details, dict) else None
+    if not isinstance(vulnerabilities, list):
+        vulnerabilities = []
+    vulnerabilities = [v for v in vulnerabilities if isinstance(v, dict)]
+
+    counts = {}
+    for severity in SEVERITIES:
+        value = results.get(f'{severity}_issues')
+        if value is None:
+            # Older payloads only carry the vulnerability list
+            value = sum(1 for v in vulnerabilities if str(v.get('severity', '')).lower() == severity)
+        try:
+            counts[severity] = max(int(value), 0)
+        except (TypeError, ValueError):
+            counts[severity] = 0
+
+    issue_types = [str(v.get('type'))[:200] for v in vulnerabilities if v.get('type')]
+    return score, counts, issue_types
+
+def record_audit_completion(conn, completed_at, plan_type, results):
+    """Fold one completed audit into the daily summaries (caller commits, then calls mark_stale)"""
+    day = str(completed_at)[:10]
+    plan_type = plan_type or 'free'
+    score, counts, issue_types = summarize_results(results)
+
+    conn.execute('''
+        INSERT INTO audit_daily_summary (day, plan_type, audits, critical_issues, major_issues, minor_issues)
+        VALUES (?, ?, 1, ?, ?, ?)
+        ON CONFLICT (day, plan_type) DO UPDATE SET
+            audits = audits + 1,
+            critical_issues = critical_issues + excluded.critical_issues,
+            major_issues = major_issues + excluded.major_issues,
+            minor_issues = minor_issues + excluded.minor_issues
+    ''', (day, plan_type, counts['critical'], counts['major'], counts['minor']))
+
+    if score is not None:
+        bucket = min(int(score // 10), SCORE_BUCKETS - 1)
+        conn.execute(f'''
+            UPDATE audit_daily_summary SET
+                scored_audits = scored_audits + 1,
+                score_sum = score_sum + ?,
+                score_bucket_{bucket} = score_bucket_{bucket} + 1
+            WHERE day = ? AND plan_type = ?
+        ''', (score, day, plan_type))
+
+    for issue_type in issue_types:
+        conn.execute('''
+            INSERT INTO audit_issue_daily (day, plan_type, issue_type, occurrences)
+            VALUES (?, ?, ?, 1)
+            ON CONFLICT (day, plan_type, issue_type) DO UPDATE SET occurrences = occurrences + 1
+        ''', (day, plan_type, issue_type))
+
+def rebuild_summaries(conn):
+    """Recompute the summaries from all completed audits"""
+    conn.execute('DELETE FROM audit_daily_summary')
+    conn.execute('DELETE FROM audit_issue_daily')
+    cursor = conn.execute('''
+        SELECT COALESCE(a.completed_at, a.created_at), u.plan_type, a.results
+        FROM audits a JOIN users u ON u.id = a.user_id
+        WHERE a.status = 'completed'
+    ''')
+    for completed_at, plan_type, results in cursor.fetchall():
+        record_audit_completion(conn, completed_at, plan_type, results)
+
+class AnalyticsColumns:
+    """Per-worker columnar copy of the summary tables, refreshed on a TTL"""
+
+    def __init__(self, ttl_seconds=COLUMN_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._loaded_at = 0.0
+        self._version = 0
+        self._loaded_version = -1
+        self._version_lock = threading.Lock()
+        self._summary = None
+        self._issues = None
+
+    def mark_stale(self):
+        """Force a reload after a committed write"""
+        with self._version_lock:
+            self._version += 1
+
+    def get(self, connect):
+        with self._lock:
+            if self._summary is None or self._loaded_version != self._version or time.monotonic() - self._loaded_at > self.ttl_seconds:
+                # A write committed during the load bumps the version and forces another reload
+                version = self._version
+                conn = connect()
+                try:
+                    self._summary, self._issues = self._load(conn)
+                finally:
+                    conn.close()
+                self._loaded_at = time.monotonic()
+                self._loaded_version = version
+            return self._summary, self._issues
+
+    @staticmethod
+    def _load(conn):
+        bucket_columns = ', '.join(f'score_bucket_{i}' for i in range(SCORE_BUCKETS))
+        rows = conn.execute(f'''
+            SELECT day, plan_type, audits, score_sum, critical_issues, major_issues, minor_issues, scored_audits, {bucket_columns}
+            FROM audit_daily_summary
+        ''').fetchall()
+        plans = sorted({row[1] for row in rows})
+        plan_index = {plan: i for i, plan in enumerate(plans)}
+        summary = {
+            'plans': plans,
+            'day': np.array([_day_ordinal(row[0]) for row in rows], dtype=np.int32),
+            'plan': np.array([plan_index[row[1]] for row in rows], dtype=np.int32),
+            'audits': np.array([row[2] for row in rows], dtype=np.int64),
+            'score_sum': np.array([row[3] for row in rows], dtype=np.float64),
+            'severity': np.array([row[4:7] for row in rows], dtype=np.int64).reshape(-1, len(SEVERITIES)),
+            'scored': np.array([row[7] for row in rows], dtype=np.int64),
+            'buckets': np.array([row[8:] for row in rows], dtype=np.int64).reshape(-1, SCORE_BUCKETS)
+        }
+
+        rows = conn.execute('SELECT day, plan_type, issue_type, occurrences FROM audit_issue_daily').fetchall()
+        issue_types = sorted({row[2] for row in rows})
+        issue_index = {issue: i for i, issue in enumerate(issue_types)}
+        issues = {
+            'types': issue_types,
+            'day': np.array([_day_ordinal(row[0]) for row in rows], dtype=np.int32),
+            'plan': np.array([plan_index.get(row[1], -1) for row in rows], dtype=np.int32),
+            'issue': np.array([issue_index[row[2]] for row in rows], dtype=np.int32),
+            'occurrences': np.array([row[3] for row in rows], dtype=np.int64)
+        }
+        return summary, issues
+
+analytics_columns = AnalyticsColumns()
+
+def _day_ordinal(day):
+    try:
+        return datetime.date.fromisoformat(day).toordinal()
+    except (TypeError, ValueError):
+        return 0
+
+def _window_mask(days, plans, date_from, date_to, plan_id):
+    mask = np.ones(days.shape, dtype=bool)
+    if date_from:
+        mask &= days >= date_from.toordinal()
+    if date_to:
+        mask &= days <= date_to.toordinal()
+    if plan_id is not None:
+        mask &= plans == plan_id
+    return mask
+
+def query_analytics(connect, date_from=None, date_to=None, plan=None, top_issues=10):
+    """Aggregate the summaries over a date window (inclusive) and optional plan"""
+    summary, issues = analytics_columns.get(connect)
+    plan_id = None
+    if plan is not None:
+        plan_id = summary['plans'].index(plan) if plan in summary['plans'] else -2
+
+    mask = _window_mask(summary['day'], summary['plan'], date_from, date_to, plan_id)
+    audits = summary['audits'][mask]
+    total_audits = int(audits.sum())
+    scored = summary['scored'][mask]
+    scored_audits = int(scored.sum())
+    score_sum = float(summary['score_sum'][mask].sum())
+    severity_totals = summary['severity'][mask].sum(axis=0)
+    histogram = summary['buckets'][mask].sum(axis=0)
+
+    plan_count = len(summary['plans'])
+    plan_audits = np.bincount(summary['plan'][mask], weights=audits, minlength=plan_count)
+    plan_scored = np.bincount(summary['plan'][mask], weights=scored, minlength=plan_count)
+    plan_scores = np.bincount(summary['plan'][mask], weights=summary['score_sum'][mask], minlength=plan_count)
+
+    issue_mask = _window_mask(issues['day'], issues['plan'], date_from, date_to, plan_id)
+    issue_totals = np.bincount(
+        issues['issue'][issue_mask],
+        weights=issues['occurrences'][issue_mask],
+        minlength=len(issues['types'])
+    )
+    top = np.argsort(-issue_totals, kind='stable')[:top_issues]
+
+    return {
+        'window': {
+            'from': date_from.isoformat() if date_from else None,
+            'to': date_to.isoformat() if date_to else None,
+            'plan': plan
+        },
+        'audits': total_audits,
+        'score': {
+            'scoredAudits': scored_audits,
+            'average': round(score_sum / scored_audits, 2) if scored_audits else None,
+            'histogram': [
+                {'min': i * 10, 'max': 100 if i == SCORE_BUCKETS - 1 else i * 10 + 9, 'count': int(histogram[i])}
+                for i in range(SCORE_BUCKETS)
+            ]
+        },
+        'findings': {severity: int(severity_totals[i]) for i, severity in enumerate(SEVERITIES)},
+        'top_issues': [
+            {'type': issues['types'][i], 'count': int(issue_totals[i])}
+            for i in top if issue_totals[i] > 0
+        ],
+        'plans': [
+            {
+                'plan': name,
+                'audits': int(plan_audits[i]),
+                'averageScore': round(float(plan_scores[i] / plan_scored[i]), 2) if plan_scored[i] else None
+            }
+            for i, name in enumerate(summary['plans']) if plan_audits[i] > 0
+        ]
+    }
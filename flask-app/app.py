@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -6,12 +6,24 @@ import sqlite3
 import bcrypt
 import jwt
 import datetime
+import hmac
+import json
+import math
 import os
 import re
 import secrets
+import threading
 from functools import wraps
 from urllib.parse import urlparse
+from db import write_connection, read_connection, snapshot_connection, snapshot_refresher
 from security_middleware import add_security_headers, check_request_size, advanced_rate_limit
+from exports import EXPORT_DATASETS, EXPORT_FORMATS, stream_export
+from user_cache import user_profile_cache, etag_matches
+from analytics import init_analytics_tables, rebuild_summaries, record_audit_completion, query_analytics, analytics_columns
+from webhooks import (
+    WEBHOOK_MAX_ENDPOINTS_PER_USER, init_webhook_tables, enqueue_audit_completed,
+    WEBHOOK_ALLOW_PRIVATE_DESTINATIONS, is_public_destination, webhook_dispatcher
+)
 
 app = Flask(__name__)
 
@@ -19,6 +31,8 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_urlsafe(32))
 app.config['JWT_EXPIRATION_HOURS'] = int(os.environ.get('JWT_EXPIRATION_HOURS', '24'))
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max request size
+# Shared secret of the internal scanner; audit completion is disabled when unset
+app.config['SCANNER_API_KEY'] = os.environ.get('SCANNER_API_KEY', '')
 
 # CORS configuration - restrictive for production
 if os.environ.get('FLASK_ENV') == 'production':
@@ -57,6 +71,22 @@ def validate_url(url):
     except:
         return False
 
+def validate_audit_results(results):
+    if not isinstance(results, dict):
+        return False, "Résultats requis"
+    score = results.get('security_score')
+    if score is not None:
+        if isinstance(score, bool) or not isinstance(score, (int, float)) or not math.isfinite(score) or not 0 <= score <= 100:
+            return False, "Score de sécurité invalide"
+    for severity in ('critical', 'major', 'minor'):
+        count = results.get(f'{severity}_issues')
+        if count is not None and (isinstance(count, bool) or not isinstance(count, int) or count < 0):
+            return False, "Nombre de vulnérabilités invalide"
+    scan_details = results.get('scan_details')
+    if scan_details is not None and not isinstance(scan_details, dict):
+        return False, "Détails du scan invalides"
+    return True, "Valide"
+
 def sanitize_input(text, max_length=255):
     if not isinstance(text, str):
         return ""
@@ -66,7 +96,7 @@ def sanitize_input(text, max_length=255):
 
 # Database initialization with security
 def init_db():
-    conn = sqlite3.connect('cybak.db', check_same_thread=False)
+    conn = write_connection()
     conn.execute('PRAGMA foreign_keys = ON')  # Enable foreign key constraints
     conn.execute('PRAGMA journal_mode = WAL')  # Better concurrency
     cursor = conn.cursor()
@@ -100,8 +130,31 @@ def init_db():
         )
     ''')
     
+    # Webhook endpoints and delivery queue
+    init_webhook_tables(conn)
+    
+    # Analytics summaries, backfilled once from existing completed audits
+    init_analytics_tables(conn)
+    cursor.execute('SELECT COUNT(*) FROM audit_daily_summary')
+    if cursor.fetchone()[0] == 0:
+        rebuild_summaries(conn)
+    
     conn.commit()
     conn.close()
+    analytics_columns.mark_stale()
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def ensure_schema():
+    """Run init_db once per process; gunicorn imports the app without the __main__ block"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            init_db()
+            _schema_ready = True
 
 # JWT token verification decorator
 def token_required(f):
@@ -156,7 +209,7 @@ def admin_required(f):
             current_user_id = data['user_id']
             
             # Check if user is admin
-            conn = sqlite3.connect('cybak.db')
+            conn = read_connection()
             cursor = conn.cursor()
             cursor.execute('SELECT is_admin FROM users WHERE id = ?', (current_user_id,))
             user = cursor.fetchone()
@@ -175,6 +228,17 @@ def admin_required(f):
         return f(current_user_id, *args, **kwargs)
     return decorated
 
+# Internal scanner verification decorator
+def scanner_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        expected = app.config['SCANNER_API_KEY']
+        provided = request.headers.get('X-Scanner-Key', '')
+        if not expected or not hmac.compare_digest(provided.encode('utf-8'), expected.encode('utf-8')):
+            return jsonify({'error': 'Accès scanner requis'}), 403
+        return f(*args, **kwargs)
+    return decorated
+
 # Auth endpoints with rate limiting
 @app.route('/api/auth/signup', methods=['POST'])
 @limiter.limit("5 per minute")
@@ -207,7 +271,7 @@ def signup():
     password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
     
     try:
-        conn = sqlite3.connect('cybak.db')
+        conn = write_connection()
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO users (email, password_hash, first_name, last_name)
@@ -263,7 +327,7 @@ def login():
     except Exception as e:
         return jsonify({'error': 'Données invalides'}), 400
     
-    conn = sqlite3.connect('cybak.db')
+    conn = read_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT id, email, password_hash, first_name, last_name FROM users WHERE email = ?', (email,))
     user = cursor.fetchone()
@@ -296,28 +360,43 @@ def login():
         }
     }), 200
 
-@app.route('/api/auth/me', methods=['GET'])
-@token_required
-def get_current_user(current_user_id):
-    conn = sqlite3.connect('cybak.db')
+def load_user_profile(user_id):
+    conn = read_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT id, email, first_name, last_name, subscription_status, plan_type FROM users WHERE id = ?', (current_user_id,))
+    cursor.execute('SELECT id, email, first_name, last_name, subscription_status, plan_type FROM users WHERE id = ?', (user_id,))
     user = cursor.fetchone()
     conn.close()
     
     if not user:
+        return None
+    
+    return {
+        'id': user[0],
+        'email': user[1],
+        'firstName': user[2],
+        'lastName': user[3],
+        'subscriptionStatus': user[4],
+        'planType': user[5]
+    }
+
+@app.route('/api/auth/me', methods=['GET'])
+@token_required
+def get_current_user(current_user_id):
+    profile, etag = user_profile_cache.get(current_user_id, load_user_profile)
+    
+    if not profile:
         return jsonify({'error': 'Utilisateur non trouvé'}), 404
     
-    return jsonify({
-        'user': {
-            'id': user[0],
-            'email': user[1],
-            'firstName': user[2],
-            'lastName': user[3],
-            'subscriptionStatus': user[4],
-            'planType': user[5]
-        }
-    }), 200
+    # Unchanged profile: let the SPA reuse its copy
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({'user': profile})
+    
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Authorization'
+    return response
 
 # Audit endpoints
 @app.route('/api/audits', methods=['POST'])
@@ -343,7 +422,7 @@ def create_audit(current_user_id):
     except Exception as e:
         return jsonify({'error': 'Données invalides'}), 400
     
-    conn = sqlite3.connect('cybak.db')
+    conn = write_connection()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO audits (user_id, url, status)
@@ -364,7 +443,7 @@ def create_audit(current_user_id):
 @app.route('/api/audits', methods=['GET'])
 @token_required
 def get_user_audits(current_user_id):
-    conn = sqlite3.connect('cybak.db')
+    conn = read_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT id, url, status, results, created_at, completed_at
@@ -390,7 +469,7 @@ def get_user_audits(current_user_id):
 @app.route('/api/audits/<int:audit_id>', methods=['GET'])
 @token_required
 def get_audit(current_user_id, audit_id):
-    conn = sqlite3.connect('cybak.db')
+    conn = read_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT id, url, status, results, created_at, completed_at
@@ -413,11 +492,153 @@ def get_audit(current_user_id, audit_id):
         }
     }), 200
 
+@app.route('/api/audits/<int:audit_id>/complete', methods=['POST'])
+@scanner_required
+def complete_audit(audit_id):
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'Résultats requis'}), 400
+    
+    is_valid, results_msg = validate_audit_results(data.get('results'))
+    if not is_valid:
+        return jsonify({'error': results_msg}), 400
+    
+    results = json.dumps(data['results'])
+    completed_at = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    
+    conn = write_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE audits SET status = 'completed', results = ?, completed_at = ?
+        WHERE id = ? AND status != 'completed'
+    ''', (results, completed_at, audit_id))
+    
+    if cursor.rowcount == 0:
+        conn.close()
+        return jsonify({'error': 'Audit non trouvé ou déjà terminé'}), 404
+    
+    cursor.execute('''
+        SELECT a.id, a.url, a.status, a.user_id, a.created_at, a.completed_at, u.plan_type
+        FROM audits a JOIN users u ON u.id = a.user_id WHERE a.id = ?
+    ''', (audit_id,))
+    audit = cursor.fetchone()
+    record_audit_completion(conn, completed_at, audit[6], data['results'])
+    
+    queued = enqueue_audit_completed(conn, audit[3], {
+        'id': audit[0],
+        'url': audit[1],
+        'status': audit[2],
+        'results': data['results'],
+        'createdAt': audit[4],
+        'completedAt': audit[5]
+    })
+    conn.commit()
+    conn.close()
+    
+    analytics_columns.mark_stale()
+    if queued:
+        webhook_dispatcher.notify()
+    
+    return jsonify({
+        'audit': {
+            'id': audit_id,
+            'status': 'completed',
+            'completedAt': completed_at
+        }
+    }), 200
+
+# Webhook endpoints
+@app.route('/api/webhooks', methods=['POST'])
+@token_required
+@limiter.limit("10 per hour")
+def create_webhook(current_user_id):
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'Données JSON requises'}), 400
+    
+    url = str(data.get('url', '')).strip()
+    if not url or len(url) > 2048 or not validate_url(url):
+        return jsonify({'error': 'Format d\'URL invalide'}), 400
+    
+    if os.environ.get('FLASK_ENV') == 'production' and urlparse(url).scheme != 'https':
+        return jsonify({'error': 'URL de webhook non autorisée'}), 400
+    
+    # Re-checked at send time; this only gives early feedback
+    if not WEBHOOK_ALLOW_PRIVATE_DESTINATIONS and not is_public_destination(url):
+        return jsonify({'error': 'URL de webhook non autorisée'}), 400
+    
+    conn = write_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM webhook_endpoints WHERE user_id = ? AND is_active = 1', (current_user_id,))
+    if cursor.fetchone()[0] >= WEBHOOK_MAX_ENDPOINTS_PER_USER:
+        conn.close()
+        return jsonify({'error': 'Nombre maximum de webhooks atteint'}), 409
+    
+    secret = secrets.token_hex(32)
+    cursor.execute('''
+        INSERT INTO webhook_endpoints (user_id, url, secret)
+        VALUES (?, ?, ?)
+    ''', (current_user_id, url, secret))
+    webhook_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    
+    # The signing secret is only ever returned once
+    return jsonify({
+        'webhook': {
+            'id': webhook_id,
+            'url': url,
+            'secret': secret
+        }
+    }), 201
+
+@app.route('/api/webhooks', methods=['GET'])
+@token_required
+def get_user_webhooks(current_user_id):
+    conn = read_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT e.id, e.url, e.created_at,
+            SUM(CASE WHEN d.status IN ('pending', 'sending') THEN 1 ELSE 0 END),
+            SUM(CASE WHEN d.status = 'failed' THEN 1 ELSE 0 END)
+        FROM webhook_endpoints e LEFT JOIN webhook_deliveries d ON d.endpoint_id = e.id
+        WHERE e.user_id = ? AND e.is_active = 1
+        GROUP BY e.id
+        ORDER BY e.created_at DESC
+    ''', (current_user_id,))
+    webhooks = cursor.fetchall()
+    conn.close()
+    
+    return jsonify({'webhooks': [{
+        'id': webhook[0],
+        'url': webhook[1],
+        'createdAt': webhook[2],
+        'pendingDeliveries': webhook[3] or 0,
+        'failedDeliveries': webhook[4] or 0
+    } for webhook in webhooks]}), 200
+
+@app.route('/api/webhooks/<int:webhook_id>', methods=['DELETE'])
+@token_required
+def delete_webhook(current_user_id, webhook_id):
+    conn = write_connection()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE webhook_endpoints SET is_active = 0 WHERE id = ? AND user_id = ? AND is_active = 1', (webhook_id, current_user_id))
+    
+    if cursor.rowcount == 0:
+        conn.close()
+        return jsonify({'error': 'Webhook non trouvé'}), 404
+    
+    webhook_dispatcher.cancel_endpoint(conn, webhook_id)
+    conn.commit()
+    conn.close()
+    
+    return jsonify({'message': 'Webhook supprimé'}), 200
+
 # Admin endpoints
 @app.route('/api/admin/stats', methods=['GET'])
 @admin_required
 def get_admin_stats(current_user_id):
-    conn = sqlite3.connect('cybak.db')
+    conn = snapshot_connection()
     cursor = conn.cursor()
     
     # Get user statistics
@@ -474,6 +695,31 @@ def get_admin_stats(current_user_id):
         'registrations_by_day': [{'date': row[0], 'count': row[1]} for row in registrations_by_day]
     }), 200
 
+@app.route('/api/admin/analytics', methods=['GET'])
+@admin_required
+def get_admin_analytics(current_user_id):
+    try:
+        date_from = request.args.get('from', '').strip()
+        date_to = request.args.get('to', '').strip()
+        date_from = datetime.date.fromisoformat(date_from) if date_from else None
+        date_to = datetime.date.fromisoformat(date_to) if date_to else None
+    except ValueError:
+        return jsonify({'error': 'Format de date invalide (AAAA-MM-JJ)'}), 400
+    
+    plan = sanitize_input(request.args.get('plan', ''), 50) or None
+    top_issues = min(max(request.args.get('top', 10, type=int), 1), 50)
+    
+    return jsonify(query_analytics(read_connection, date_from, date_to, plan, top_issues)), 200
+
+@app.route('/api/admin/webhooks/metrics', methods=['GET'])
+@admin_required
+def get_webhook_metrics(current_user_id):
+    # Counters and latencies are per worker; queue depth comes from the database
+    return jsonify({
+        'worker': webhook_dispatcher.metrics.snapshot(),
+        'queue': webhook_dispatcher.queue_stats()
+    }), 200
+
 @app.route('/api/admin/users', methods=['GET'])
 @admin_required
 def get_all_users(current_user_id):
@@ -481,7 +727,7 @@ def get_all_users(current_user_id):
     per_page = min(request.args.get('per_page', 20, type=int), 100)  # Max 100 per page
     search = request.args.get('search', '').strip()
     
-    conn = sqlite3.connect('cybak.db')
+    conn = snapshot_connection()
     cursor = conn.cursor()
     
     # Build query with search
@@ -538,7 +784,7 @@ def get_all_users(current_user_id):
 @app.route('/api/admin/users/<int:user_id>/audits', methods=['GET'])
 @admin_required
 def get_user_audits_admin(current_user_id, user_id):
-    conn = sqlite3.connect('cybak.db')
+    conn = snapshot_connection()
     cursor = conn.cursor()
     
     # Get user info
@@ -577,10 +823,46 @@ def get_user_audits_admin(current_user_id, user_id):
         'audits': audit_list
     }), 200
 
+@app.route('/api/admin/export/<dataset>', methods=['GET'])
+@admin_required
+@limiter.limit("10 per hour")
+def export_admin_data(current_user_id, dataset):
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({'error': 'Export inconnu'}), 404
+    
+    export_format = request.args.get('format', 'csv').strip().lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'Format d\'export invalide'}), 400
+    
+    date_from = request.args.get('from', '').strip() or None
+    date_to = request.args.get('to', '').strip() or None
+    try:
+        for value in (date_from, date_to):
+            if value:
+                datetime.date.fromisoformat(value)
+    except ValueError:
+        return jsonify({'error': 'Format de date invalide (AAAA-MM-JJ)'}), 400
+    
+    plan = sanitize_input(request.args.get('plan', ''), 50) or None
+    
+    # Only compress when the client says it can decode gzip
+    compress = 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+    
+    body = stream_export(snapshot_connection, dataset, export_format, date_from, date_to, plan, compress)
+    response = Response(stream_with_context(body), mimetype=EXPORT_FORMATS[export_format])
+    filename = f"cybak-{dataset}-{datetime.date.today().isoformat()}.{export_format}"
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 @app.route('/api/admin/promote/<int:user_id>', methods=['POST'])
 @admin_required
 def promote_user_to_admin(current_user_id, user_id):
-    conn = sqlite3.connect('cybak.db')
+    conn = write_connection()
     cursor = conn.cursor()
     
     cursor.execute('UPDATE users SET is_admin = 1 WHERE id = ?', (user_id,))
@@ -594,6 +876,38 @@ def promote_user_to_admin(current_user_id, user_id):
     
     return jsonify({'message': 'Utilisateur promu administrateur'}), 200
 
+# Writes to cached profile fields must go through here so /api/auth/me stays current
+def update_user_plan(user_id, plan_type, subscription_status=None):
+    conn = write_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE users SET plan_type = ?, subscription_status = COALESCE(?, subscription_status)
+        WHERE id = ?
+    ''', (plan_type, subscription_status, user_id))
+    updated = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    
+    user_profile_cache.invalidate(user_id)
+    return updated
+
+@app.route('/api/admin/users/<int:user_id>/plan', methods=['PUT'])
+@admin_required
+def update_user_plan_admin(current_user_id, user_id):
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'Données JSON requises'}), 400
+    
+    plan_type = sanitize_input(data.get('planType', ''), 50)
+    subscription_status = sanitize_input(data.get('subscriptionStatus', ''), 50) or None
+    if not plan_type:
+        return jsonify({'error': 'Plan requis'}), 400
+    
+    if not update_user_plan(user_id, plan_type, subscription_status):
+        return jsonify({'error': 'Utilisateur non trouvé'}), 404
+    
+    return jsonify({'message': 'Plan mis à jour'}), 200
+
 @app.route('/')
 def home():
     return jsonify({
@@ -607,7 +921,7 @@ def home():
 
 # Create default admin user
 def create_default_admin():
-    conn = sqlite3.connect('cybak.db')
+    conn = write_connection()
     cursor = conn.cursor()
     
     # Check if admin exists
@@ -634,6 +948,7 @@ def create_default_admin():
 # Apply security middleware
 @app.before_request
 def before_request():
+    ensure_schema()
     # Check request size
     size_check = check_request_size()
     if size_check:
@@ -644,8 +959,12 @@ def after_request(response):
     return add_security_headers(response)
 
 if __name__ == '__main__':
-    init_db()
+    ensure_schema()
     create_default_admin()
     # Disable debug in production
     debug_mode = os.environ.get('FLASK_ENV') != 'production'
+    # With the reloader, only the child process serves requests
+    if not debug_mode or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        webhook_dispatcher.start()
+        snapshot_refresher.start()
     app.run(host='0.0.0.0', port=8080, debug=debug_mode)
@@ -0,0 +1,115 @@
+# Database connection routing for CYBAK Flask backend
+#
+# Writes and reads that must see the latest data go to the primary database.
+# Admin and reporting reads go to a snapshot copy that a background thread
+# refreshes with the SQLite backup API, so long scans do not hold read locks
+# on the file that handles signups and audit writes.
+
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'cybak.db')
+SNAPSHOT_PATH = os.environ.get('DATABASE_SNAPSHOT_PATH', 'cybak-snapshot.db')
+
+# Maximum age of the snapshot served to reporting reads; an older (or missing)
+# snapshot falls back to a read-only primary connection.
+# 0 disables the snapshot and serves reporting reads from the primary.
+SNAPSHOT_MAX_STALENESS_SECONDS = int(os.environ.get('DATABASE_SNAPSHOT_MAX_STALENESS', '60'))
+
+logger = logging.getLogger(__name__)
+
+def write_connection():
+    """Connection to the primary database for writes and read-your-writes queries"""
+    return sqlite3.connect(DATABASE_PATH)
+
+def read_connection():
+    """Read-only connection to the primary database for fresh reads"""
+    return sqlite3.connect(f'file:{DATABASE_PATH}?mode=ro', uri=True)
+
+def snapshot_age():
+    """Seconds since the snapshot was last refreshed, or None if it does not exist"""
+    try:
+        return time.time() - os.path.getmtime(SNAPSHOT_PATH)
+    except OSError:
+        return None
+
+def refresh_snapshot():
+    """Copy the primary into a new snapshot file and swap it in atomically"""
+    directory = os.path.dirname(os.path.abspath(SNAPSHOT_PATH))
+    fd, tmp_path = tempfile.mkstemp(prefix='.cybak-snapshot-', suffix='.db', dir=directory)
+    os.close(fd)
+    try:
+        started = time.time()
+        source = read_connection()
+        target = sqlite3.connect(tmp_path)
+        try:
+            # One step copies everything inside a single read transaction. Stepping in
+            # chunks restarts the copy whenever another connection writes the primary.
+            source.backup(target, pages=-1)
+            # The copy inherits WAL mode; a rollback journal keeps read-only opens simple
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+        # The snapshot's age is measured from when its data was read
+        os.utime(tmp_path, (started, started))
+        # Readers holding the previous file keep reading it until they close
+        os.replace(tmp_path, SNAPSHOT_PATH)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class SnapshotRefresher:
+    """Background thread keeping the snapshot younger than the staleness bound"""
+
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the refresh thread once per worker"""
+        if SNAPSHOT_MAX_STALENESS_SECONDS <= 0:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='snapshot-refresher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        interval = SNAPSHOT_MAX_STALENESS_SECONDS / 2
+        while not self._stop.is_set():
+            try:
+                # Every worker runs a refresher; skip the copy if another one just made it
+                age = snapshot_age()
+                if age is None or age >= interval:
+                    refresh_snapshot()
+            except Exception:
+                logger.exception('Snapshot refresh failed')
+            self._stop.wait(interval)
+
+snapshot_refresher = SnapshotRefresher()
+
+def snapshot_connection():
+    """Read-only connection for admin and reporting queries, at most the staleness bound old"""
+    if SNAPSHOT_MAX_STALENESS_SECONDS <= 0:
+        return read_connection()
+
+    age = snapshot_age()
+    if age is None or age > SNAPSHOT_MAX_STALENESS_SECONDS:
+        # The refresher has not caught up (or is not running); never serve older data
+        return read_connection()
+
+    return sqlite3.connect(f'file:{SNAPSHOT_PATH}?mode=ro', uri=True)
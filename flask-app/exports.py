@@ -0,0 +1,144 @@
+# Streaming exports for CYBAK admin endpoints
+
+import csv
+import io
+import json
+import zlib
+
+# Rows pulled from the cursor per round trip
+EXPORT_BATCH_SIZE = 1000
+
+# Flush the gzip stream once this many uncompressed bytes are pending
+GZIP_FLUSH_BYTES = 64 * 1024
+
+EXPORT_DATASETS = {
+    'users': {
+        'query': '''
+            SELECT id, email, first_name, last_name, created_at, subscription_status, plan_type, is_admin
+            FROM users
+        ''',
+        'date_column': 'created_at',
+        'plan_column': 'plan_type',
+        'columns': ['id', 'email', 'firstName', 'lastName', 'createdAt', 'subscriptionStatus', 'planType', 'isAdmin']
+    },
+    'audits': {
+        'query': '''
+            SELECT a.id, a.user_id, u.email, u.plan_type, a.url, a.status, a.results, a.created_at, a.completed_at
+            FROM audits a JOIN users u ON u.id = a.user_id
+        ''',
+        'date_column': 'a.created_at',
+        'plan_column': 'u.plan_type',
+        'columns': ['id', 'userId', 'email', 'planType', 'url', 'status', 'results', 'createdAt', 'completedAt'],
+        'json_columns': ['results']
+    }
+}
+
+# Leading characters spreadsheet applications evaluate as a formula
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson'
+}
+
+def build_export_query(dataset, date_from=None, date_to=None, plan=None):
+    """Build the SQL query and parameters for an export with optional filters"""
+    spec = EXPORT_DATASETS[dataset]
+    conditions = []
+    params = []
+
+    if date_from:
+        conditions.append(f"DATE({spec['date_column']}) >= DATE(?)")
+        params.append(date_from)
+    if date_to:
+        conditions.append(f"DATE({spec['date_column']}) <= DATE(?)")
+        params.append(date_to)
+    if plan:
+        conditions.append(f"{spec['plan_column']} = ?")
+        params.append(plan)
+
+    query = spec['query']
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    # Primary key order lets SQLite walk the table without a sort buffer
+    query += ' ORDER BY ' + ('a.id' if dataset == 'audits' else 'id')
+    return query, params
+
+def iter_rows(connect, query, params):
+    """Yield rows from a cursor in batches, keeping one batch in memory"""
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        conn.close()
+
+def _normalize_row(dataset, row):
+    row = list(row)
+    if dataset == 'users':
+        row[7] = bool(row[7])
+    return row
+
+def escape_csv_cell(value):
+    """Neutralize CSV formula injection in user-controlled text"""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def iter_csv(dataset, rows):
+    """Encode rows as CSV, one chunk per row"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_DATASETS[dataset]['columns'])
+    for row in rows:
+        writer.writerow([escape_csv_cell(value) for value in _normalize_row(dataset, row)])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def iter_ndjson(dataset, rows):
+    """Encode rows as newline-delimited JSON objects"""
+    columns = EXPORT_DATASETS[dataset]['columns']
+    json_columns = EXPORT_DATASETS[dataset].get('json_columns', [])
+    for row in rows:
+        record = dict(zip(columns, _normalize_row(dataset, row)))
+        for column in json_columns:
+            # Stored as serialized JSON; emit it nested rather than as a string
+            if isinstance(record[column], str):
+                try:
+                    record[column] = json.loads(record[column])
+                except ValueError:
+                    pass
+        yield (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+def iter_gzip(chunks):
+    """Compress a byte stream on the fly, flushing in bounded blocks"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 emits a gzip header
+    pending = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= GZIP_FLUSH_BYTES:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush(zlib.Z_FINISH)
+
+def stream_export(connect, dataset, export_format, date_from=None, date_to=None, plan=None, compress=True):
+    """Return a generator producing the encoded (and optionally gzipped) export"""
+    query, params = build_export_query(dataset, date_from, date_to, plan)
+    rows = iter_rows(connect, query, params)
+    encoder = iter_csv if export_format == 'csv' else iter_ndjson
+    chunks = encoder(dataset, rows)
+    return iter_gzip(chunks) if compress else chunks
@@ -0,0 +1,9 @@
+# Gunicorn settings for CYBAK Flask backend (loaded automatically from the working directory)
+
+def post_fork(server, worker):
+    # Threads do not survive fork, so each worker starts its own webhook sender and snapshot refresher
+    from app import ensure_schema, snapshot_refresher, webhook_dispatcher
+    # The sender queries the webhook tables immediately, before any request creates them
+    ensure_schema()
+    webhook_dispatcher.start()
+    snapshot_refresher.start()
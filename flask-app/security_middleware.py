@@ -1,9 +1,18 @@
 # Security middleware for CYBAK Flask backend
 
-from flask import request, jsonify
+from flask import request, jsonify, after_this_request
+import os
+import math
 import time
+import hmac
 import hashlib
+import sqlite3
+import tempfile
+import threading
 from functools import wraps
+from urllib.parse import parse_qsl, urlencode
+from werkzeug.wsgi import get_input_stream
+from db import DATABASE_PATH
 
 # Security headers middleware
 def add_security_headers(response):
@@ -65,38 +74,164 @@ def advanced_rate_limit(max_requests=100, window_minutes=10, block_duration_minu
     return decorator
 
 # Request signature validation (for API integrity)
-def validate_request_signature(secret_key):
+SIGNATURE_TOLERANCE_SECONDS = 300  # 5 minutes
+BODY_CHUNK_SIZE = 64 * 1024
+BODY_SPOOL_MAX_MEMORY = 1024 * 1024  # Larger bodies spill to a temp file
+
+class NonceStoreFull(Exception):
+    """Raised when the replay cache is at capacity with unexpired nonces"""
+
+class NonceStore:
+    """Replay cache for signed requests, shared across workers through SQLite"""
+
+    def __init__(self, db_path=DATABASE_PATH, ttl_seconds=SIGNATURE_TOLERANCE_SECONDS, max_entries=100000):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS request_nonces (
+                        nonce TEXT PRIMARY KEY,
+                        expires_at REAL NOT NULL
+                    )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_request_nonces_expires ON request_nonces (expires_at)')
+                self._initialized = True
+        return conn
+
+    def register(self, nonce, req_time, now=None):
+        """Record a nonce until its request timestamp leaves the tolerance window.
+
+        Returns False if the nonce was already seen. Raises NonceStoreFull rather
+        than evicting live nonces, since dropping one would reopen its replay.
+        """
+        now = time.time() if now is None else now
+        conn = self._connection()
+        # A request stays valid while now <= req_time + tolerance, so keep the nonce until then
+        conn.execute('DELETE FROM request_nonces WHERE expires_at < ?', (now,))
+        count = conn.execute('SELECT COUNT(*) FROM request_nonces').fetchone()[0]
+        if count >= self.max_entries:
+            raise NonceStoreFull()
+        try:
+            conn.execute('INSERT INTO request_nonces (nonce, expires_at) VALUES (?, ?)', (nonce, req_time + self.ttl_seconds))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+nonce_store = NonceStore()
+
+def canonical_query_string(query_string):
+    """Sort query parameters so equivalent URLs sign identically"""
+    pairs = parse_qsl(query_string, keep_blank_values=True)
+    return urlencode(sorted(pairs))
+
+def build_canonical_request(method, path, query_string, timestamp, nonce, body_digest):
+    """Canonical form covered by the request HMAC"""
+    return '\n'.join([
+        method.upper(),
+        path,
+        canonical_query_string(query_string),
+        timestamp,
+        nonce,
+        body_digest
+    ]).encode('utf-8')
+
+def compute_request_signature(secret_key, method, path, query_string, timestamp, nonce, body=b''):
+    """HMAC-SHA256 signature for a request, as clients should send it"""
+    body_digest = hashlib.sha256(body).hexdigest()
+    canonical = build_canonical_request(method, path, query_string, timestamp, nonce, body_digest)
+    return hmac.new(secret_key.encode('utf-8'), canonical, hashlib.sha256).hexdigest()
+
+def _digest_request_body():
+    """Hash the request body in chunks and rewind it for the view"""
+    environ = request.environ
+    stream = get_input_stream(environ, max_content_length=request.max_content_length)
+    spool = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_MAX_MEMORY)
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(BODY_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        spool.write(chunk)
+        size += len(chunk)
+    spool.seek(0)
+
+    # Hand the buffered body back to Werkzeug as a plain sized stream
+    environ['wsgi.input'] = spool
+    environ['CONTENT_LENGTH'] = str(size)
+    environ.pop('wsgi.input_terminated', None)
+    environ.pop('HTTP_TRANSFER_ENCODING', None)
+
+    @after_this_request
+    def close_spool(response):
+        spool.close()
+        return response
+
+    return digest.hexdigest()
+
+def validate_request_signature(secret_key, store=None):
     """Validate request signature for critical operations"""
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            # Skip signature validation in development
-            if request.headers.get('X-Skip-Signature') == 'development':
+            # Skip signature validation in development only
+            if os.environ.get('FLASK_ENV') != 'production' and request.headers.get('X-Skip-Signature') == 'development':
                 return f(*args, **kwargs)
             
-            signature = request.headers.get('X-Request-Signature')
-            timestamp = request.headers.get('X-Request-Timestamp')
+            signature = request.headers.get('X-Request-Signature', '')
+            timestamp = request.headers.get('X-Request-Timestamp', '')
+            nonce = request.headers.get('X-Request-Nonce', '')
             
-            if not signature or not timestamp:
+            if not signature or not timestamp or not nonce:
                 return jsonify({'error': 'Signature de requête manquante'}), 401
             
+            if len(nonce) > 128:
+                return jsonify({'error': 'Nonce invalide'}), 401
+            
             # Check timestamp (prevent replay attacks)
             try:
                 req_time = float(timestamp)
-                if abs(time.time() - req_time) > 300:  # 5 minutes tolerance
+                if not math.isfinite(req_time):
+                    return jsonify({'error': 'Timestamp invalide'}), 401
+                if abs(time.time() - req_time) > SIGNATURE_TOLERANCE_SECONDS:
                     return jsonify({'error': 'Requête expirée'}), 401
             except ValueError:
                 return jsonify({'error': 'Timestamp invalide'}), 401
             
             # Validate signature
-            request_data = request.get_data()
-            expected_signature = hashlib.sha256(
-                f"{timestamp}{request.method}{request.path}{request_data.decode('utf-8', errors='ignore')}{secret_key}".encode()
-            ).hexdigest()
+            body_digest = _digest_request_body()
+            canonical = build_canonical_request(
+                request.method,
+                request.path,
+                request.query_string.decode('latin-1'),
+                timestamp,
+                nonce,
+                body_digest
+            )
+            expected_signature = hmac.new(secret_key.encode('utf-8'), canonical, hashlib.sha256).hexdigest()
             
-            if signature != expected_signature:
+            if not hmac.compare_digest(signature.lower().encode('ascii', 'replace'), expected_signature.encode('ascii')):
                 return jsonify({'error': 'Signature invalide'}), 401
             
+            # Only remember nonces of authentic requests so forgeries cannot fill the cache
+            try:
+                if not (store or nonce_store).register(nonce, req_time):
+                    return jsonify({'error': 'Requête déjà traitée'}), 401
+            except NonceStoreFull:
+                return jsonify({'error': 'Service temporairement indisponible'}), 503
+            
             return f(*args, **kwargs)
         return decorated_function
     return decorator
@@ -0,0 +1,56 @@
+import datetime
+import os
+import sqlite3
+import sys
+
+import bcrypt
+import jwt
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as cybak  # noqa: E402
+import db  # noqa: E402
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Fresh primary database and snapshot path under a temp directory"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(db, 'DATABASE_PATH', str(tmp_path / 'cybak.db'))
+    monkeypatch.setattr(db, 'SNAPSHOT_PATH', str(tmp_path / 'cybak-snapshot.db'))
+    # Reporting reads see writes immediately unless a test opts into staleness
+    monkeypatch.setattr(db, 'SNAPSHOT_MAX_STALENESS_SECONDS', 0)
+    monkeypatch.setattr(cybak.webhook_dispatcher, 'db_path', db.DATABASE_PATH)
+    cybak.init_db()
+    monkeypatch.setattr(cybak, '_schema_ready', True)
+    return db.DATABASE_PATH
+
+@pytest.fixture
+def client(database):
+    cybak.app.config['TESTING'] = True
+    cybak.limiter.enabled = False
+    return cybak.app.test_client()
+
+def create_user(email, plan_type='free', is_admin=False, first_name='', last_name=''):
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO users (email, password_hash, first_name, last_name, plan_type, is_admin)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (email, bcrypt.hashpw(b'Password1', bcrypt.gensalt(4)), first_name, last_name, plan_type, int(is_admin)))
+    user_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return user_id
+
+def auth_headers(user_id):
+    token = jwt.encode({
+        'user_id': user_id,
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+        'iss': 'cybak-api'
+    }, cybak.app.config['SECRET_KEY'], algorithm='HS256')
+    return {'Authorization': f'Bearer {token}'}
+
+@pytest.fixture
+def admin_headers(database):
+    return auth_headers(create_user('admin@cybak.xyz', is_admin=True))
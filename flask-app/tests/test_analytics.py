@@ -0,0 +1,162 @@
+import datetime
+import random
+import sqlite3
+import time
+
+import pytest
+
+import app as cybak
+import db
+from analytics import AnalyticsColumns, analytics_columns, query_analytics, record_audit_completion
+from conftest import create_user, auth_headers
+
+SCANNER_KEY = 'test-scanner-key'
+
+@pytest.fixture
+def scanner_headers(monkeypatch):
+    monkeypatch.setitem(cybak.app.config, 'SCANNER_API_KEY', SCANNER_KEY)
+    return {'X-Scanner-Key': SCANNER_KEY}
+
+def _record(day, plan, score, vulnerabilities=()):
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    record_audit_completion(conn, f'{day} 12:00:00', plan, {
+        'security_score': score,
+        'scan_details': {'vulnerabilities': [{'type': t, 'severity': s} for t, s in vulnerabilities]}
+    })
+    conn.commit()
+    conn.close()
+    analytics_columns.mark_stale()
+
+def test_query_filters_by_window_and_plan(database):
+    _record('2025-01-10', 'free', 40, [('XSS', 'critical')])
+    _record('2025-01-20', 'pro', 90, [('CSP', 'minor'), ('XSS', 'critical')])
+    _record('2025-02-05', 'pro', 70, [('CSP', 'minor')])
+
+    everything = query_analytics(db.read_connection)
+    assert everything['audits'] == 3
+    assert everything['findings'] == {'critical': 2, 'major': 0, 'minor': 2}
+    assert everything['score']['average'] == pytest.approx(200 / 3, abs=0.01)
+    assert [issue['type'] for issue in everything['top_issues']] == ['CSP', 'XSS']
+
+    january = query_analytics(db.read_connection, datetime.date(2025, 1, 1), datetime.date(2025, 1, 31))
+    assert january['audits'] == 2
+    assert {p['plan']: p['audits'] for p in january['plans']} == {'free': 1, 'pro': 1}
+    assert january['score']['histogram'][4]['count'] == 1
+    assert january['score']['histogram'][9]['count'] == 1
+
+    pro = query_analytics(db.read_connection, plan='pro')
+    assert pro['audits'] == 2
+    assert pro['score']['average'] == 80.0
+    assert pro['findings']['critical'] == 1
+
+    pro_february = query_analytics(db.read_connection, datetime.date(2025, 2, 1), plan='pro')
+    assert pro_february['audits'] == 1
+    assert pro_february['top_issues'] == [{'type': 'CSP', 'count': 1}]
+
+    assert query_analytics(db.read_connection, plan='enterprise')['audits'] == 0
+    assert query_analytics(db.read_connection, datetime.date(2030, 1, 1))['score']['average'] is None
+
+def test_unscored_audits_stay_out_of_score_statistics(database):
+    _record('2025-03-01', 'pro', 80)
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    record_audit_completion(conn, '2025-03-01 13:00:00', 'pro', {'critical_issues': 2})
+    record_audit_completion(conn, '2025-03-02 13:00:00', 'free', {'security_score': None})
+    conn.commit()
+    conn.close()
+    analytics_columns.mark_stale()
+
+    summary = query_analytics(db.read_connection)
+    assert summary['audits'] == 3
+    assert summary['findings']['critical'] == 2
+    assert summary['score']['scoredAudits'] == 1
+    assert summary['score']['average'] == 80.0
+    assert sum(bucket['count'] for bucket in summary['score']['histogram']) == 1
+    assert summary['score']['histogram'][0]['count'] == 0
+    assert {p['plan']: p['averageScore'] for p in summary['plans']} == {'free': None, 'pro': 80.0}
+
+def test_summaries_without_scored_column_are_migrated(database):
+    user_id = create_user('legacy@example.com', plan_type='pro')
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    conn.execute("""
+        INSERT INTO audits (user_id, url, status, results, completed_at)
+        VALUES (?, 'https://example.com', 'completed', '{"critical_issues": 1}', '2025-04-01 10:00:00')
+    """, (user_id,))
+    conn.execute('ALTER TABLE audit_daily_summary DROP COLUMN scored_audits')
+    conn.execute("INSERT INTO audit_daily_summary (day, plan_type, audits, score_bucket_0) VALUES ('2025-04-01', 'pro', 1, 1)")
+    conn.commit()
+    conn.close()
+
+    cybak.init_db()
+    summary = query_analytics(db.read_connection)
+    assert summary['audits'] == 1
+    assert summary['score']['average'] is None
+    assert summary['score']['histogram'][0]['count'] == 0
+
+def test_year_window_query_under_50ms(database):
+    rng = random.Random(0)
+    start = datetime.date(2025, 1, 1)
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    for _ in range(20000):
+        day = start + datetime.timedelta(days=rng.randrange(365))
+        record_audit_completion(conn, day.isoformat(), rng.choice(['free', 'pro', 'business']), {
+            'security_score': rng.randrange(101),
+            'scan_details': {'vulnerabilities': [{'type': f'issue-{rng.randrange(300)}', 'severity': 'major'}]}
+        })
+    conn.commit()
+    conn.close()
+    analytics_columns.mark_stale()
+
+    window = (datetime.date(2025, 1, 1), datetime.date(2025, 12, 31))
+    assert query_analytics(db.read_connection, *window)['audits'] == 20000  # warm the columns
+
+    timings = []
+    for plan in (None, 'pro', 'business', None, 'free'):
+        started = time.perf_counter()
+        query_analytics(db.read_connection, *window, plan=plan)
+        timings.append(time.perf_counter() - started)
+    assert sorted(timings)[len(timings) // 2] < 0.05
+
+def test_write_during_reload_forces_another_reload(database):
+    columns = AnalyticsColumns(ttl_seconds=3600)
+    loads = []
+
+    def connect():
+        loads.append(1)
+        if len(loads) == 1:
+            # A completion commits while the first load is in progress
+            columns.mark_stale()
+        return sqlite3.connect(db.DATABASE_PATH)
+
+    columns.get(connect)
+    columns.get(connect)
+    columns.get(connect)
+    assert len(loads) == 2
+
+def test_complete_audit_requires_scanner_key(client, scanner_headers):
+    user_id = create_user('owner@example.com', plan_type='pro')
+    audit_id = client.post('/api/audits', json={'url': 'https://example.com'},
+                           headers=auth_headers(user_id)).json['audit']['id']
+    payload = {'results': {'security_score': 85, 'critical_issues': 0}}
+
+    # The audit owner cannot report their own results
+    assert client.post(f'/api/audits/{audit_id}/complete', json=payload,
+                       headers=auth_headers(user_id)).status_code == 403
+    assert client.post(f'/api/audits/{audit_id}/complete', json=payload,
+                       headers={'X-Scanner-Key': 'wrong'}).status_code == 403
+
+    for bad in ({'security_score': 250}, {'security_score': 'A+'}, {'critical_issues': -3}, {'scan_details': []}):
+        assert client.post(f'/api/audits/{audit_id}/complete', json={'results': bad},
+                           headers=scanner_headers).status_code == 400
+
+    response = client.post(f'/api/audits/{audit_id}/complete', json=payload, headers=scanner_headers)
+    assert response.status_code == 200
+    assert client.post(f'/api/audits/{audit_id}/complete', json=payload, headers=scanner_headers).status_code == 404
+
+    summary = query_analytics(db.read_connection, plan='pro')
+    assert summary['audits'] == 1
+    assert summary['score']['average'] == 85.0
+
+def test_complete_audit_disabled_without_key(client, monkeypatch):
+    monkeypatch.setitem(cybak.app.config, 'SCANNER_API_KEY', '')
+    assert client.post('/api/audits/1/complete', json={'results': {}},
+                       headers={'X-Scanner-Key': ''}).status_code == 403
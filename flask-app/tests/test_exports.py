@@ -0,0 +1,81 @@
+import csv
+import gzip
+import io
+import json
+import sqlite3
+import zlib
+
+import db
+import exports
+from conftest import create_user
+
+def _rows(text):
+    return list(csv.DictReader(io.StringIO(text)))
+
+def test_csv_export_filters_by_plan_and_date(client, admin_headers):
+    create_user('free@example.com', plan_type='free')
+    create_user('pro@example.com', plan_type='pro')
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    conn.execute("UPDATE users SET created_at = '2024-01-15 10:00:00' WHERE email = 'free@example.com'")
+    conn.commit()
+    conn.close()
+
+    response = client.get('/api/admin/export/users?plan=pro', headers=admin_headers)
+    assert response.status_code == 200
+    assert [row['email'] for row in _rows(response.data.decode())] == ['pro@example.com']
+
+    response = client.get('/api/admin/export/users?from=2024-01-01&to=2024-01-31', headers=admin_headers)
+    assert [row['email'] for row in _rows(response.data.decode())] == ['free@example.com']
+
+def test_invalid_export_parameters(client, admin_headers):
+    assert client.get('/api/admin/export/payments', headers=admin_headers).status_code == 404
+    assert client.get('/api/admin/export/users?format=xml', headers=admin_headers).status_code == 400
+    assert client.get('/api/admin/export/users?from=yesterday', headers=admin_headers).status_code == 400
+
+def test_csv_export_escapes_formulas(client, admin_headers):
+    create_user('victim@example.com', first_name='=HYPERLINK(x)', last_name='@SUM(A1)')
+
+    response = client.get('/api/admin/export/users', headers=admin_headers)
+    row = [row for row in _rows(response.data.decode()) if row['email'] == 'victim@example.com'][0]
+    assert row['firstName'] == "'=HYPERLINK(x)"
+    assert row['lastName'] == "'@SUM(A1)"
+
+def test_ndjson_export_nests_results(client, admin_headers):
+    user_id = create_user('audited@example.com')
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    conn.execute('INSERT INTO audits (user_id, url, results) VALUES (?, ?, ?)',
+                 (user_id, 'https://example.com', json.dumps({'security_score': 80})))
+    conn.commit()
+    conn.close()
+
+    response = client.get('/api/admin/export/audits?format=ndjson', headers=admin_headers)
+    records = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert records[0]['results'] == {'security_score': 80}
+    assert records[0]['email'] == 'audited@example.com'
+
+def test_gzip_export_streams_in_blocks(client, admin_headers, monkeypatch):
+    monkeypatch.setattr(exports, 'EXPORT_BATCH_SIZE', 7)
+    monkeypatch.setattr(exports, 'GZIP_FLUSH_BYTES', 256)
+    for i in range(100):
+        create_user(f'user{i}@example.com')
+
+    response = client.get('/api/admin/export/users',
+                          headers={**admin_headers, 'Accept-Encoding': 'gzip'}, buffered=False)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    chunks = [chunk for chunk in response.response if chunk]
+    response.close()
+    assert len(chunks) > 2
+
+    # Every flushed block decodes on its own, so clients can consume the stream incrementally
+    decompressor = zlib.decompressobj(31)
+    decoded = b''.join(decompressor.decompress(chunk) for chunk in chunks[:-1])
+    assert decoded.startswith(b'id,email')
+
+    rows = _rows(gzip.decompress(b''.join(chunks)).decode())
+    assert len(rows) == 101  # admin + generated users
+    assert [int(row['id']) for row in rows] == sorted(int(row['id']) for row in rows)
+
+def test_export_without_gzip_support_is_plain(client, admin_headers):
+    response = client.get('/api/admin/export/users?format=ndjson', headers=admin_headers)
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(response.data.decode().splitlines()[0])['email'] == 'admin@cybak.xyz'
@@ -0,0 +1,101 @@
+import time
+import uuid
+
+import pytest
+from flask import Flask, jsonify, request
+
+import security_middleware
+from security_middleware import NonceStore, compute_request_signature, validate_request_signature
+
+SECRET = 'test-signing-secret'
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(security_middleware.time, 'time', clock)
+    return clock
+
+@pytest.fixture
+def store(tmp_path):
+    return NonceStore(str(tmp_path / 'nonces.db'), max_entries=3)
+
+@pytest.fixture
+def signed_client(store):
+    app = Flask(__name__)
+
+    @app.route('/upload', methods=['POST'])
+    @validate_request_signature(SECRET, store)
+    def upload():
+        return jsonify({'size': len(request.get_data())})
+
+    return app.test_client()
+
+def signed_headers(body, timestamp, nonce=None, query=''):
+    nonce = nonce or uuid.uuid4().hex
+    return {
+        'X-Request-Timestamp': timestamp,
+        'X-Request-Nonce': nonce,
+        'X-Request-Signature': compute_request_signature(SECRET, 'POST', '/upload', query, timestamp, nonce, body)
+    }
+
+def test_valid_signature_passes_body_through(signed_client, clock):
+    body = b'x' * (3 * 1024 * 1024)
+    response = signed_client.post('/upload?b=2&a=1', data=body,
+                                  headers=signed_headers(body, str(clock.now), query='a=1&b=2'))
+    assert response.status_code == 200
+    assert response.json == {'size': len(body)}
+
+def test_tampered_body_is_rejected(signed_client, clock):
+    headers = signed_headers(b'{"amount": 1}', str(clock.now))
+    response = signed_client.post('/upload', data=b'{"amount": 9}', headers=headers)
+    assert response.status_code == 401
+    assert response.json['error'] == 'Signature invalide'
+
+def test_replay_is_rejected(signed_client, clock):
+    headers = signed_headers(b'body', str(clock.now))
+    assert signed_client.post('/upload', data=b'body', headers=headers).status_code == 200
+    response = signed_client.post('/upload', data=b'body', headers=headers)
+    assert response.status_code == 401
+    assert response.json['error'] == 'Requête déjà traitée'
+
+def test_future_dated_replay_is_rejected(signed_client, clock):
+    headers = signed_headers(b'body', str(clock.now + 290))
+    assert signed_client.post('/upload', data=b'body', headers=headers).status_code == 200
+
+    # Still inside the tolerance window of the request timestamp
+    clock.now += 301
+    assert signed_client.post('/upload', data=b'body', headers=headers).status_code == 401
+
+    # Once the timestamp itself is out of the window the request is refused as expired
+    clock.now += 300
+    response = signed_client.post('/upload', data=b'body', headers=headers)
+    assert response.status_code == 401
+    assert response.json['error'] == 'Requête expirée'
+
+@pytest.mark.parametrize('timestamp', ['nan', 'inf', '-inf', 'NaN'])
+def test_non_finite_timestamp_is_rejected(signed_client, clock, timestamp):
+    response = signed_client.post('/upload', data=b'body', headers=signed_headers(b'body', timestamp))
+    assert response.status_code == 401
+    assert response.json['error'] == 'Timestamp invalide'
+
+def test_full_store_refuses_instead_of_evicting(signed_client, store, clock):
+    replayable = signed_headers(b'body', str(clock.now))
+    assert signed_client.post('/upload', data=b'body', headers=replayable).status_code == 200
+    for _ in range(2):
+        assert signed_client.post('/upload', data=b'body', headers=signed_headers(b'body', str(clock.now))).status_code == 200
+
+    response = signed_client.post('/upload', data=b'body', headers=signed_headers(b'body', str(clock.now)))
+    assert response.status_code == 503
+    # The earliest nonce is still remembered
+    assert signed_client.post('/upload', data=b'body', headers=replayable).status_code != 200
+
+    # Expired nonces free up room again
+    clock.now += 301
+    assert signed_client.post('/upload', data=b'body', headers=signed_headers(b'body', str(clock.now))).status_code == 200
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import threading
+import time
+
+import db
+from conftest import create_user
+
+def _count_users(conn):
+    try:
+        return conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    finally:
+        conn.close()
+
+def test_reporting_reads_are_stale_within_the_bound_only(database, monkeypatch):
+    monkeypatch.setattr(db, 'SNAPSHOT_MAX_STALENESS_SECONDS', 1)
+    create_user('first@example.com')
+    db.refresh_snapshot()
+
+    create_user('second@example.com')
+    assert _count_users(db.snapshot_connection()) == 1
+
+    # Past the bound without a refresh, reads fall back to the primary
+    time.sleep(1.1)
+    assert _count_users(db.snapshot_connection()) == 2
+
+    refresher = db.SnapshotRefresher()
+    refresher.start()
+    try:
+        deadline = time.time() + 5
+        while db.snapshot_age() is None or db.snapshot_age() > 1:
+            assert time.time() < deadline
+            time.sleep(0.02)
+    finally:
+        refresher.stop()
+    assert _count_users(sqlite3.connect(f'file:{db.SNAPSHOT_PATH}?mode=ro', uri=True)) == 2
+    assert not [name for name in os.listdir(os.path.dirname(db.SNAPSHOT_PATH)) if name.startswith('.cybak-snapshot-')]
+
+def test_refresh_completes_while_another_connection_writes(database):
+    # Larger than one backup step used to be, so a stepped copy would keep restarting
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    conn.executemany("INSERT INTO audits (user_id, url, results) VALUES (1, 'https://example.com', ?)",
+                     [('x' * 4000,)] * 3000)
+    conn.commit()
+    conn.close()
+
+    stop = threading.Event()
+    committed = []
+
+    def write():
+        conn = sqlite3.connect(db.DATABASE_PATH, timeout=5)
+        while not stop.is_set():
+            conn.execute("INSERT INTO audits (user_id, url) VALUES (1, 'https://example.com')")
+            conn.commit()
+            committed.append(1)
+        conn.close()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        while len(committed) < 50:
+            time.sleep(0.01)
+        before = len(committed)
+        started = time.monotonic()
+        db.refresh_snapshot()
+        elapsed = time.monotonic() - started
+        after = len(committed)
+    finally:
+        stop.set()
+        writer.join()
+
+    assert elapsed < 2
+    conn = sqlite3.connect(f'file:{db.SNAPSHOT_PATH}?mode=ro', uri=True)
+    try:
+        assert conn.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+        copied = conn.execute('SELECT COUNT(*) FROM audits').fetchone()[0]
+    finally:
+        conn.close()
+    assert 3000 + before <= copied <= 3000 + after
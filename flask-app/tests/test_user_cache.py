@@ -0,0 +1,84 @@
+import app as cybak
+from conftest import create_user, auth_headers
+from user_cache import UserProfileCache, etag_matches, user_profile_cache
+
+def test_cache_serves_hits_until_invalidated():
+    cache = UserProfileCache()
+    loads = []
+
+    def loader(user_id):
+        loads.append(user_id)
+        return {'id': user_id, 'planType': 'free'}
+
+    first = cache.get(1, loader)
+    assert cache.get(1, loader) == first
+    assert loads == [1]
+
+    cache.invalidate(1)
+    cache.get(1, loader)
+    assert loads == [1, 1]
+
+def test_invalidation_during_load_is_not_overwritten():
+    cache = UserProfileCache()
+    profiles = iter([{'id': 1, 'planType': 'free'}, {'id': 1, 'planType': 'pro'}])
+
+    def racing_loader(user_id):
+        profile = next(profiles)
+        # A write lands after the row was read but before the result is cached
+        cache.invalidate(user_id)
+        return profile
+
+    stale, _ = cache.get(1, racing_loader)
+    assert stale['planType'] == 'free'
+
+    fresh, _ = cache.get(1, lambda user_id: next(profiles))
+    assert fresh['planType'] == 'pro'
+
+def test_clear_during_load_is_not_overwritten():
+    cache = UserProfileCache()
+
+    def racing_loader(user_id):
+        cache.clear()
+        return {'id': user_id}
+
+    cache.get(1, racing_loader)
+    assert cache.get(1, lambda user_id: {'id': user_id, 'fresh': True})[0] == {'id': 1, 'fresh': True}
+
+def test_etag_matching():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc", "def"', '"abc"')
+    assert etag_matches('*', '"abc"')
+    assert not etag_matches('"def"', '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+def test_me_returns_304_and_refreshes_after_plan_change(client, admin_headers):
+    user_profile_cache.clear()
+    user_id = create_user('member@example.com')
+    headers = auth_headers(user_id)
+
+    response = client.get('/api/auth/me', headers=headers)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    response = client.get('/api/auth/me', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    assert cybak.update_user_plan(user_id, 'pro', 'active')
+
+    response = client.get('/api/auth/me', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json['user']['planType'] == 'pro'
+    assert response.json['user']['subscriptionStatus'] == 'active'
+    assert response.headers['ETag'] != etag
+
+def test_admin_plan_update_is_visible_immediately(client, admin_headers):
+    user_profile_cache.clear()
+    user_id = create_user('upgrader@example.com')
+    headers = auth_headers(user_id)
+    assert client.get('/api/auth/me', headers=headers).json['user']['planType'] == 'free'
+
+    response = client.put(f'/api/admin/users/{user_id}/plan', json={'planType': 'business'}, headers=admin_headers)
+    assert response.status_code == 200
+    assert client.get('/api/auth/me', headers=headers).json['user']['planType'] == 'business'
+    assert client.put('/api/admin/users/9999/plan', json={'planType': 'pro'}, headers=admin_headers).status_code == 404
@@ -0,0 +1,274 @@
+import json
+import socket
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app as cybak
+import db
+import webhooks
+from conftest import create_user, auth_headers
+from webhooks import DestinationNotAllowed, WebhookDispatcher, enqueue_audit_completed, resolve_destination, sign_payload
+
+class Receiver:
+    """Local stand-in for an integrator's webhook endpoint"""
+
+    def __init__(self, statuses=(), delay=0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with receiver.lock:
+                    receiver.active += 1
+                    receiver.max_active = max(receiver.max_active, receiver.active)
+                time.sleep(receiver.delay)
+                with receiver.lock:
+                    receiver.active -= 1
+                status = receiver.statuses.pop(0) if receiver.statuses else 204
+                receiver.requests.append({'time': time.time(), 'headers': dict(self.headers), 'body': body, 'status': status})
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/hooks/cybak'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(webhooks, 'WEBHOOK_POLL_INTERVAL_SECONDS', 0.05)
+    monkeypatch.setattr(webhooks, 'WEBHOOK_BACKOFF_BASE_SECONDS', 0.4)
+
+@pytest.fixture
+def make_dispatcher(database, fast_retries):
+    dispatchers = []
+
+    def make(allow_private=True):
+        dispatcher = WebhookDispatcher(db_path=database, allow_private=allow_private)
+        dispatchers.append(dispatcher)
+        return dispatcher
+
+    yield make
+    for dispatcher in dispatchers:
+        dispatcher.stop()
+
+@pytest.fixture
+def receiver():
+    receiver = Receiver()
+    yield receiver
+    receiver.close()
+
+def register_endpoint(url, secret='whsec-test'):
+    user_id = create_user(f'integrator{time.time_ns()}@example.com')
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    endpoint_id = conn.execute('INSERT INTO webhook_endpoints (user_id, url, secret) VALUES (?, ?, ?)',
+                               (user_id, url, secret)).lastrowid
+    conn.commit()
+    conn.close()
+    return user_id, endpoint_id
+
+def complete_audits(user_id, count):
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    for _ in range(count):
+        audit_id = conn.execute("INSERT INTO audits (user_id, url, status) VALUES (?, 'https://example.com', 'completed')",
+                                (user_id,)).lastrowid
+        enqueue_audit_completed(conn, user_id, {'id': audit_id, 'status': 'completed'})
+    conn.commit()
+    conn.close()
+
+def deliveries():
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    rows = conn.execute('SELECT status, attempts, next_attempt_at, last_error FROM webhook_deliveries ORDER BY id').fetchall()
+    conn.close()
+    return rows
+
+def wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+def test_completions_are_batched_and_signed(make_dispatcher, receiver):
+    user_id, _ = register_endpoint(receiver.url, secret='whsec-batch')
+    complete_audits(user_id, 5)
+
+    dispatcher = make_dispatcher()
+    dispatcher.start()
+    assert wait_for(lambda: all(row[0] == 'delivered' for row in deliveries()))
+
+    assert len(receiver.requests) == 1
+    request = receiver.requests[0]
+    events = json.loads(request['body'])['events']
+    assert len(events) == 5
+    assert {event['type'] for event in events} == {'audit.completed'}
+
+    timestamp = request['headers']['X-Cybak-Timestamp']
+    assert request['headers']['X-Cybak-Signature'] == sign_payload('whsec-batch', timestamp, request['body'])
+    assert dispatcher.metrics.snapshot()['counters']['events_delivered'] == 5
+
+def test_server_error_is_retried_with_backoff(make_dispatcher, receiver):
+    receiver.statuses = [500]
+    user_id, _ = register_endpoint(receiver.url)
+    complete_audits(user_id, 1)
+
+    dispatcher = make_dispatcher()
+    dispatcher.start()
+    assert wait_for(lambda: deliveries()[0][0] == 'delivered')
+
+    assert [request['status'] for request in receiver.requests] == [500, 204]
+    # First retry waits between half and all of the base delay
+    assert receiver.requests[1]['time'] - receiver.requests[0]['time'] >= 0.2
+    status, attempts, _, last_error = deliveries()[0]
+    assert attempts == 2 and last_error is None
+    counters = dispatcher.metrics.snapshot()['counters']
+    assert counters['batches_failed'] == 1 and counters['batches_delivered'] == 1
+
+def test_delivery_is_abandoned_after_max_attempts(make_dispatcher, receiver, monkeypatch):
+    monkeypatch.setattr(webhooks, 'WEBHOOK_MAX_ATTEMPTS', 3)
+    receiver.statuses = [500] * 10
+    user_id, _ = register_endpoint(receiver.url)
+    complete_audits(user_id, 1)
+
+    dispatcher = make_dispatcher()
+    dispatcher.start()
+    assert wait_for(lambda: deliveries()[0][0] == 'failed')
+    time.sleep(0.3)
+
+    assert len(receiver.requests) == 3
+    assert deliveries()[0][1:2] == (3,)
+    assert deliveries()[0][3] == 'HTTP 500'
+    assert dispatcher.metrics.snapshot()['counters']['events_abandoned'] == 1
+
+def test_slow_origin_does_not_starve_other_destinations(make_dispatcher, monkeypatch):
+    monkeypatch.setattr(webhooks, 'WEBHOOK_SENDER_THREADS', 4)
+    tarpit, fast = Receiver(delay=1), Receiver()
+    try:
+        slow_user, _ = register_endpoint(tarpit.url)
+        complete_audits(slow_user, 200)
+        fast_user, _ = register_endpoint(fast.url)
+        complete_audits(fast_user, 1)
+
+        dispatcher = make_dispatcher()
+        started = time.time()
+        dispatcher.start()
+        assert wait_for(lambda: len(fast.requests) == 1, timeout=5)
+        assert fast.requests[0]['time'] - started < 0.9
+
+        # Only the batches the origin may send at once are claimed; the backlog stays pending
+        statuses = [row[0] for row in deliveries()]
+        assert statuses.count('sending') <= webhooks.WEBHOOK_PER_DESTINATION_CONCURRENCY * webhooks.WEBHOOK_BATCH_SIZE
+        assert tarpit.max_active <= webhooks.WEBHOOK_PER_DESTINATION_CONCURRENCY
+    finally:
+        dispatcher.stop()
+        tarpit.close()
+        fast.close()
+
+def test_batch_cancelled_before_send_is_dropped(make_dispatcher, receiver):
+    user_id, endpoint_id = register_endpoint(receiver.url)
+    complete_audits(user_id, 3)
+
+    dispatcher = make_dispatcher()
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    batches = dispatcher._claim_batches(conn, 1)
+    dispatcher.cancel_endpoint(conn, endpoint_id)
+    conn.commit()
+    conn.close()
+
+    dispatcher._send_batch(*batches[0])
+    assert receiver.requests == []
+    assert {row[0] for row in deliveries()} == {'cancelled'}
+    assert dispatcher._inflight == 0
+
+def test_finished_deliveries_are_pruned_after_retention(make_dispatcher, receiver):
+    user_id, endpoint_id = register_endpoint(receiver.url)
+    old = time.time() - (webhooks.WEBHOOK_RETENTION_DAYS + 1) * 86400
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    for status, created_at in (('delivered', old), ('failed', old), ('cancelled', old),
+                               ('pending', old), ('delivered', time.time())):
+        conn.execute('''
+            INSERT INTO webhook_deliveries (endpoint_id, audit_id, payload, status, next_attempt_at, created_at)
+            VALUES (?, 1, '{}', ?, ?, ?)
+        ''', (endpoint_id, status, time.time() + 3600, created_at))
+    conn.commit()
+    conn.close()
+
+    make_dispatcher().dispatch_due()
+    assert [row[0] for row in deliveries()] == ['pending', 'delivered']
+
+def test_private_destination_is_refused_at_send_time(make_dispatcher, receiver):
+    user_id, _ = register_endpoint(receiver.url)
+    complete_audits(user_id, 1)
+
+    dispatcher = make_dispatcher(allow_private=False)
+    dispatcher.start()
+    assert wait_for(lambda: deliveries()[0][1] == 1)
+
+    assert receiver.requests == []
+    assert 'non-public' in deliveries()[0][3]
+
+def test_rebinding_answer_with_internal_address_is_rejected(monkeypatch):
+    answers = [
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('93.184.216.34', 443)),
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('169.254.169.254', 443))
+    ]
+    monkeypatch.setattr(webhooks.socket, 'getaddrinfo', lambda *args, **kwargs: answers)
+    with pytest.raises(DestinationNotAllowed):
+        resolve_destination('hooks.example.com', 443)
+
+    monkeypatch.setattr(webhooks.socket, 'getaddrinfo', lambda *args, **kwargs: answers[:1])
+    assert resolve_destination('hooks.example.com', 443) == '93.184.216.34'
+
+def test_deleting_endpoint_cancels_queued_deliveries(client, monkeypatch):
+    monkeypatch.setattr(cybak, 'WEBHOOK_ALLOW_PRIVATE_DESTINATIONS', True)
+    user_id = create_user('owner@example.com')
+    headers = auth_headers(user_id)
+
+    response = client.post('/api/webhooks', json={'url': 'http://127.0.0.1:9/hook'}, headers=headers)
+    assert response.status_code == 201
+    webhook_id = response.json['webhook']['id']
+    complete_audits(user_id, 2)
+
+    assert client.delete(f'/api/webhooks/{webhook_id}', headers=headers).status_code == 200
+    assert cybak.webhook_dispatcher.queue_stats() == {'cancelled': 2}
+
+def test_private_destination_rejected_at_registration(client):
+    headers = auth_headers(create_user('owner@example.com'))
+    response = client.post('/api/webhooks', json={'url': 'http://127.0.0.1:9/hook'}, headers=headers)
+    assert response.status_code == 400
+
+def test_tables_created_on_first_request(tmp_path, monkeypatch):
+    # Under gunicorn the __main__ block never runs, so nothing calls init_db up front
+    monkeypatch.setattr(db, 'DATABASE_PATH', str(tmp_path / 'cybak.db'))
+    monkeypatch.setattr(cybak, '_schema_ready', False)
+    monkeypatch.setattr(cybak.limiter, 'enabled', False)
+    client = cybak.app.test_client()
+
+    response = client.get('/api/webhooks', headers=auth_headers(1))
+    assert response.status_code == 200
+    assert response.json['webhooks'] == []
+
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.close()
+    assert {'users', 'webhook_endpoints', 'webhook_deliveries', 'audit_daily_summary', 'audit_issue_daily'} <= tables
@@ -0,0 +1,73 @@
+# Per-worker read-through cache of user profiles for CYBAK Flask backend
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+PROFILE_CACHE_TTL_SECONDS = 60
+PROFILE_CACHE_MAX_ENTRIES = 10000
+
+class UserProfileCache:
+    """Bounded TTL cache mapping user ids to (profile, etag)"""
+
+    def __init__(self, ttl_seconds=PROFILE_CACHE_TTL_SECONDS, max_entries=PROFILE_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # Bumped by every invalidation; a load that spans one is not cached
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id, loader):
+        """Return (profile, etag) for a user, calling loader(user_id) on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1], entry[2]
+            generation = self._generation
+
+        profile = loader(user_id)
+        if profile is None:
+            return None, None
+
+        etag = compute_etag(profile)
+        with self._lock:
+            # An invalidation during the load means this profile may predate the write
+            if self._generation != generation:
+                return profile, etag
+            self._entries[user_id] = (now + self.ttl_seconds, profile, etag)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return profile, etag
+
+    def invalidate(self, user_id):
+        """Drop a cached profile after its row was written"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+def compute_etag(profile):
+    """Strong ETag derived from the serialized profile"""
+    payload = json.dumps(profile, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return '"' + hashlib.sha256(payload).hexdigest()[:32] + '"'
+
+def etag_matches(if_none_match, etag):
+    """Check an If-None-Match header value against an ETag"""
+    if not if_none_match or not etag:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(',')]
+    # Weak comparison: ignore W/ prefixes as RFC 7232 requires for If-None-Match
+    candidates = [value[2:] if value.startswith('W/') else value for value in candidates]
+    return '*' in candidates or etag in candidates
+
+user_profile_cache = UserProfileCache()
@@ -0,0 +1,480 @@
+# Webhook delivery for audit completion events
+
+import hashlib
+import hmac
+import http.client
+import ipaddress
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from db import DATABASE_PATH
+
+WEBHOOK_BATCH_SIZE = 20           # Events per POST
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_BACKOFF_BASE_SECONDS = 5
+WEBHOOK_BACKOFF_MAX_SECONDS = 3600
+WEBHOOK_TIMEOUT_SECONDS = 10
+WEBHOOK_PER_DESTINATION_CONCURRENCY = 2  # Batches in flight per origin and worker
+WEBHOOK_SENDER_THREADS = 8
+WEBHOOK_POLL_INTERVAL_SECONDS = 2
+WEBHOOK_CLAIM_TIMEOUT_SECONDS = 120  # Reclaim batches left 'sending' by a dead worker
+WEBHOOK_MAX_ENDPOINTS_PER_USER = 5
+WEBHOOK_RETENTION_DAYS = 30  # Delivered, failed and cancelled rows are pruned after this
+WEBHOOK_PRUNE_INTERVAL_SECONDS = 3600
+
+# Loopback/private receivers are only for local development
+WEBHOOK_ALLOW_PRIVATE_DESTINATIONS = os.environ.get('WEBHOOK_ALLOW_PRIVATE_DESTINATIONS', '').lower() in ('1', 'true', 'yes')
+
+logger = logging.getLogger(__name__)
+
+def init_webhook_tables(conn):
+    """Create webhook endpoint and delivery queue tables"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_endpoints (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            secret TEXT NOT NULL,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            endpoint_id INTEGER NOT NULL,
+            audit_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            delivered_at REAL,
+            FOREIGN KEY (endpoint_id) REFERENCES webhook_endpoints (id),
+            FOREIGN KEY (audit_id) REFERENCES audits (id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_due ON webhook_deliveries (status, next_attempt_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_webhook_endpoints_user ON webhook_endpoints (user_id)')
+
+def enqueue_audit_completed(conn, user_id, audit):
+    """Queue an audit.completed event for each active endpoint of a user (caller commits)"""
+    cursor = conn.execute('SELECT id FROM webhook_endpoints WHERE user_id = ? AND is_active = 1', (user_id,))
+    endpoint_ids = [row[0] for row in cursor.fetchall()]
+    if not endpoint_ids:
+        return 0
+
+    now = time.time()
+    payload = json.dumps({'type': 'audit.completed', 'audit': audit})
+    conn.executemany('''
+        INSERT INTO webhook_deliveries (endpoint_id, audit_id, payload, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(endpoint_id, audit['id'], payload, now, now) for endpoint_id in endpoint_ids])
+    return len(endpoint_ids)
+
+class DestinationNotAllowed(Exception):
+    """Receiver host does not resolve to an address deliveries may reach"""
+
+def resolve_destination(hostname, port, allow_private=False):
+    """Resolve a receiver host once and return an address that passed the check.
+
+    Every resolved address must be public, so a rebinding DNS answer cannot
+    smuggle an internal address in next to a public one.
+    """
+    try:
+        addresses = socket.getaddrinfo(hostname, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        raise DestinationNotAllowed(f'Unresolvable host {hostname}')
+    if not addresses:
+        raise DestinationNotAllowed(f'Unresolvable host {hostname}')
+    if not allow_private:
+        for address in addresses:
+            ip = ipaddress.ip_address(address[4][0].split('%')[0])
+            if not ip.is_global:
+                raise DestinationNotAllowed(f'{hostname} resolves to non-public address {ip}')
+    return addresses[0][4][0]
+
+def is_public_destination(url):
+    """Reject receivers that resolve to loopback, private or link-local addresses"""
+    parsed = urlparse(url)
+    try:
+        resolve_destination(parsed.hostname, parsed.port or 443)
+    except DestinationNotAllowed:
+        return False
+    return True
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection to a pre-checked IP, keeping the hostname for the Host header"""
+
+    def __init__(self, host, port, ip, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.ip = ip
+
+    def connect(self):
+        self.sock = socket.create_connection((self.ip, self.port), self.timeout)
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection to a pre-checked IP; SNI and certificate checks use the hostname"""
+
+    def __init__(self, host, port, ip, **kwargs):
+        super().__init__(host, port, context=ssl.create_default_context(), **kwargs)
+        self.ip = ip
+
+    def connect(self):
+        sock = socket.create_connection((self.ip, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+def _origin(url):
+    parsed = urlparse(url)
+    return (parsed.scheme, parsed.hostname, parsed.port or (443 if parsed.scheme == 'https' else 80))
+
+def sign_payload(secret, timestamp, body):
+    """Signature receivers use to authenticate a delivery"""
+    message = f'{timestamp}.'.encode('utf-8') + body
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+def backoff_delay(attempts):
+    """Exponential backoff with full jitter"""
+    ceiling = min(WEBHOOK_BACKOFF_BASE_SECONDS * (2 ** max(attempts - 1, 0)), WEBHOOK_BACKOFF_MAX_SECONDS)
+    return random.uniform(ceiling / 2, ceiling)
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections reused per origin"""
+
+    def __init__(self, max_idle_per_origin=WEBHOOK_PER_DESTINATION_CONCURRENCY):
+        self.max_idle_per_origin = max_idle_per_origin
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def acquire(self, origin, resolve, fresh=False):
+        """Return (connection, reused) for an origin; new connections go to resolve()'s address"""
+        if not fresh:
+            with self._lock:
+                if self._idle[origin]:
+                    return self._idle[origin].pop(), True
+        scheme, host, port = origin
+        ip = resolve()
+        if scheme == 'https':
+            return PinnedHTTPSConnection(host, port, ip, timeout=WEBHOOK_TIMEOUT_SECONDS), False
+        return PinnedHTTPConnection(host, port, ip, timeout=WEBHOOK_TIMEOUT_SECONDS), False
+
+    def release(self, origin, connection):
+        with self._lock:
+            if len(self._idle[origin]) < self.max_idle_per_origin:
+                self._idle[origin].append(connection)
+                return
+        connection.close()
+
+    def close_all(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+class WebhookMetrics:
+    """In-process delivery counters and latency samples"""
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._queue_latencies = []
+        self.counters = defaultdict(int)
+
+    def record(self, outcome, events, latency, queue_latency=None, abandoned=0):
+        with self._lock:
+            self.counters[f'batches_{outcome}'] += 1
+            self.counters[f'events_{outcome}'] += events
+            self.counters['events_abandoned'] += abandoned
+            self._latencies.append(latency)
+            del self._latencies[:-self.max_samples]
+            if queue_latency is not None:
+                self._queue_latencies.append(queue_latency)
+                del self._queue_latencies[:-self.max_samples]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'requestLatencyMs': _percentiles(self._latencies),
+                'deliveryLatencyMs': _percentiles(self._queue_latencies)
+            }
+
+def _percentiles(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 1)
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'samples': len(ordered)}
+
+class WebhookDispatcher:
+    """Background sender draining webhook_deliveries in batches"""
+
+    def __init__(self, db_path=DATABASE_PATH, allow_private=WEBHOOK_ALLOW_PRIVATE_DESTINATIONS):
+        self.db_path = db_path
+        self.allow_private = allow_private
+        self.pool = ConnectionPool()
+        self.metrics = WebhookMetrics()
+        self._origin_inflight = defaultdict(int)
+        self._inflight = 0
+        self._pruned_at = None
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the polling thread once per worker"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._executor = ThreadPoolExecutor(max_workers=WEBHOOK_SENDER_THREADS, thread_name_prefix='webhook')
+            self._thread = threading.Thread(target=self._run, name='webhook-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        self.pool.close_all()
+
+    def notify(self):
+        """Wake the sender right away after new events were committed"""
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.dispatch_due()
+            except Exception:
+                # Keep the sender alive; per-delivery failures are stored on the rows
+                logger.exception('Webhook dispatch failed')
+            self._wake.wait(WEBHOOK_POLL_INTERVAL_SECONDS)
+            self._wake.clear()
+
+    def dispatch_due(self):
+        """Claim due deliveries, grouped by endpoint, and hand batches to the sender pool"""
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        try:
+            self._prune_finished(conn)
+            # Only claim what the sender threads can pick up soon; the rest stays queued in SQLite
+            capacity = WEBHOOK_SENDER_THREADS * 2 - self._inflight
+            if capacity <= 0:
+                return 0
+            batches = self._claim_batches(conn, capacity)
+        finally:
+            conn.close()
+        for batch in batches:
+            self._executor.submit(self._send_batch, *batch)
+        return len(batches)
+
+    def _prune_finished(self, conn):
+        """Delete delivered, failed and cancelled rows past the retention period, at most once per interval"""
+        if self._pruned_at is not None and time.monotonic() - self._pruned_at < WEBHOOK_PRUNE_INTERVAL_SECONDS:
+            return
+        self._pruned_at = time.monotonic()
+        conn.execute('''
+            DELETE FROM webhook_deliveries
+            WHERE status IN ('delivered', 'failed', 'cancelled') AND created_at < ?
+        ''', (time.time() - WEBHOOK_RETENTION_DAYS * 86400,))
+        conn.commit()
+
+    def _claim_batches(self, conn, capacity):
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')  # Serialize claims across workers
+        conn.execute('''
+            UPDATE webhook_deliveries SET status = 'pending'
+            WHERE status = 'sending' AND next_attempt_at <= ?
+        ''', (now - WEBHOOK_CLAIM_TIMEOUT_SECONDS,))
+        # No endpoint contributes more rows than its origin could send at once,
+        # so a backlog at one receiver does not crowd the others out of the LIMIT
+        rows = conn.execute('''
+            SELECT id, endpoint_id, payload, attempts, created_at, url, secret FROM (
+                SELECT d.id, d.endpoint_id, d.payload, d.attempts, d.created_at, d.next_attempt_at, e.url, e.secret,
+                       ROW_NUMBER() OVER (PARTITION BY d.endpoint_id ORDER BY d.next_attempt_at) AS position
+                FROM webhook_deliveries d JOIN webhook_endpoints e ON e.id = d.endpoint_id
+                WHERE d.status = 'pending' AND d.next_attempt_at <= ? AND e.is_active = 1
+            )
+            WHERE position <= ?
+            ORDER BY next_attempt_at
+            LIMIT ?
+        ''', (now, WEBHOOK_PER_DESTINATION_CONCURRENCY * WEBHOOK_BATCH_SIZE, capacity * WEBHOOK_BATCH_SIZE)).fetchall()
+
+        grouped = defaultdict(list)
+        for row in rows:
+            grouped[(row[1], row[5], row[6])].append(row)
+
+        batches = []
+        with self._lock:
+            # Enforce the per-origin limit here rather than in the senders, so a slow
+            # receiver never holds a sender thread waiting for its turn; excess rows stay pending
+            for (endpoint_id, url, secret), deliveries in grouped.items():
+                origin = _origin(url)
+                for start in range(0, len(deliveries), WEBHOOK_BATCH_SIZE):
+                    if len(batches) >= capacity or self._origin_inflight[origin] >= WEBHOOK_PER_DESTINATION_CONCURRENCY:
+                        break
+                    self._origin_inflight[origin] += 1
+                    batches.append((endpoint_id, url, secret, deliveries[start:start + WEBHOOK_BATCH_SIZE]))
+            self._inflight += len(batches)
+
+        try:
+            conn.executemany(
+                "UPDATE webhook_deliveries SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                [(now, row[0]) for batch in batches for row in batch[3]]
+            )
+            conn.commit()
+        except Exception:
+            for batch in batches:
+                self._release(batch[1])
+            raise
+        return batches
+
+    def _send_batch(self, endpoint_id, url, secret, deliveries):
+        try:
+            deliveries = self._mark_started(deliveries)
+            if deliveries:
+                self._deliver(url, secret, deliveries)
+        except Exception:
+            logger.exception('Webhook batch for endpoint %s failed', endpoint_id)
+        finally:
+            self._release(url)
+
+    def _release(self, url):
+        with self._lock:
+            self._inflight -= 1
+            origin = _origin(url)
+            self._origin_inflight[origin] -= 1
+            if not self._origin_inflight[origin]:
+                del self._origin_inflight[origin]
+
+    def _mark_started(self, deliveries):
+        """Restart the claim timeout now that the send begins; drop rows cancelled or reclaimed meanwhile"""
+        ids = [row[0] for row in deliveries]
+        placeholders = ','.join('?' * len(ids))
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        try:
+            conn.execute(f'''
+                UPDATE webhook_deliveries SET next_attempt_at = ?
+                WHERE id IN ({placeholders}) AND status = 'sending'
+            ''', [time.time()] + ids)
+            still_claimed = {row[0] for row in conn.execute(
+                f"SELECT id FROM webhook_deliveries WHERE id IN ({placeholders}) AND status = 'sending'", ids
+            )}
+            conn.commit()
+        finally:
+            conn.close()
+        return [row for row in deliveries if row[0] in still_claimed]
+
+    def _deliver(self, url, secret, deliveries):
+        parsed = urlparse(url)
+        origin = _origin(url)
+        path = (parsed.path or '/') + (f'?{parsed.query}' if parsed.query else '')
+        body = json.dumps({'events': [json.loads(row[2]) for row in deliveries]}).encode('utf-8')
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'CYBAK-Webhooks/1.0',
+            'X-Cybak-Timestamp': timestamp,
+            'X-Cybak-Signature': sign_payload(secret, timestamp, body)
+        }
+
+        error = None
+        started = time.monotonic()
+        # Checked on every new connection, not just at registration, to defeat DNS rebinding
+        resolve = lambda: resolve_destination(origin[1], origin[2], self.allow_private)
+        fresh = False
+        while True:
+            try:
+                connection, reused = self.pool.acquire(origin, resolve, fresh)
+            except DestinationNotAllowed as e:
+                error = str(e)
+                break
+            try:
+                connection.request('POST', path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if reused:
+                    # The receiver may have dropped an idle keep-alive connection
+                    fresh = True
+                    continue
+                error = str(e) or e.__class__.__name__
+                break
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.release(origin, connection)
+            if not 200 <= response.status < 300:
+                error = f'HTTP {response.status}'
+            break
+        latency = time.monotonic() - started
+
+        self._finish_batch(deliveries, error, latency)
+
+    def _finish_batch(self, deliveries, error, latency):
+        now = time.time()
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        try:
+            if error is None:
+                conn.executemany(
+                    "UPDATE webhook_deliveries SET status = 'delivered', attempts = attempts + 1, delivered_at = ?, last_error = NULL WHERE id = ? AND status = 'sending'",
+                    [(now, row[0]) for row in deliveries]
+                )
+            else:
+                updates = []
+                abandoned = 0
+                for row in deliveries:
+                    attempts = row[3] + 1
+                    status = 'failed' if attempts >= WEBHOOK_MAX_ATTEMPTS else 'pending'
+                    abandoned += status == 'failed'
+                    updates.append((status, attempts, now + backoff_delay(attempts), error[:500], row[0]))
+                # Rows cancelled while in flight stay cancelled
+                conn.executemany(
+                    "UPDATE webhook_deliveries SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ? AND status = 'sending'",
+                    updates
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+        if error is None:
+            oldest = min(row[4] for row in deliveries)
+            self.metrics.record('delivered', len(deliveries), latency, now - oldest)
+        else:
+            self.metrics.record('failed', len(deliveries), latency, abandoned=abandoned)
+
+    def cancel_endpoint(self, conn, endpoint_id):
+        """Cancel queued deliveries of a deactivated endpoint (caller commits)"""
+        conn.execute('''
+            UPDATE webhook_deliveries SET status = 'cancelled'
+            WHERE endpoint_id = ? AND status IN ('pending', 'sending')
+        ''', (endpoint_id,))
+
+    def queue_stats(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            rows = conn.execute('SELECT status, COUNT(*) FROM webhook_deliveries GROUP BY status').fetchall()
+        finally:
+            conn.close()
+        return {status: count for status, count in rows}
+
+webhook_dispatcher = WebhookDispatcher()